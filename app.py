@@ -1,17 +1,25 @@
 import streamlit as st
 from datetime import datetime, timedelta
+from functools import lru_cache, partial
+from collections import namedtuple
+import zlib
+import re
+import hashlib
+import uuid
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
+import numpy as np
 from io import BytesIO
-from icalendar import Calendar
+from concurrent.futures import ThreadPoolExecutor
 import json
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Optional: Google integrations
 try:
     import gspread
     from google.oauth2.service_account import Credentials
     from googleapiclient.discovery import build
+    from google_auth_httplib2 import AuthorizedHttp
+    import httplib2
     GSHEETS_AVAILABLE = True
 except ImportError:
     GSHEETS_AVAILABLE = False
@@ -26,69 +34,201 @@ st.set_page_config(
 # ==============================
 # GOOGLE SHEETS: LOAD/SAVE DATA
 # ==============================
+SHEETS_SCOPES = ("https://www.googleapis.com/auth/spreadsheets",)
+DRIVE_SCOPES = ("https://www.googleapis.com/auth/drive.readonly",)
+
+@st.cache_resource
 def get_google_credentials(scopes):
     creds_info = st.secrets["google_sheets"]["credentials"]
     if isinstance(creds_info, str):
         creds_info = json.loads(creds_info)
-    return Credentials.from_service_account_info(creds_info, scopes=scopes)
+    return Credentials.from_service_account_info(creds_info, scopes=list(scopes))
 
-def load_sheet_data(worksheet_name):
+@st.cache_resource
+def get_gspread_client(): return gspread.authorize(get_google_credentials(SHEETS_SCOPES))
+
+@st.cache_resource
+def get_spreadsheet(): return get_gspread_client().open_by_url(st.secrets["google_sheets"]["url"])
+
+@st.cache_resource
+def get_worksheet(worksheet_name):
+    sheet = get_spreadsheet()
     try:
-        sheet_url = st.secrets["google_sheets"]["url"]
-        creds = get_google_credentials(["https://www.googleapis.com/auth/spreadsheets"])
-        gc = gspread.authorize(creds)
-        sheet = gc.open_by_url(sheet_url)
-        worksheet = sheet.worksheet(worksheet_name)
-        return worksheet.get_all_records()
-    except Exception as e:
-        st.warning(f"⚠️ Could not load '{worksheet_name}': {e}")
-        return []
+        return sheet.worksheet(worksheet_name)
+    except gspread.WorksheetNotFound:
+        return sheet.add_worksheet(title=worksheet_name, rows="1000", cols="10")
+
+@st.cache_resource
+def get_drive_service(): return build("drive", "v3", credentials=get_google_credentials(DRIVE_SCOPES))
 
-def save_sheet_data(worksheet_name, data):
+# httplib2 connections aren't thread-safe, so each request gets its own
+def execute_drive(request):
+    return request.execute(http=AuthorizedHttp(get_google_credentials(DRIVE_SCOPES), http=httplib2.Http()))
+
+# Cleared after every write
+@st.cache_data(ttl=60, show_spinner=False)
+def read_sheet_values(worksheet_name):
+    return get_worksheet(worksheet_name).get_all_values()
+
+def clear_sheet_caches():
+    read_sheet_values.clear()
+    load_modules.clear()
+    load_entries.clear()
+
+# Read errors propagate (st.cache_data never stores them); the session init handles them
+def load_sheet_data(worksheet_name):
+    rows = read_sheet_values(worksheet_name)
+    # Blank or repeated header columns are dropped
+    if not rows:
+        return pd.DataFrame()
+    df = pd.DataFrame(rows[1:], columns=rows[0])
+    return df.loc[:, ~df.columns.duplicated() & (df.columns != '')]
+
+SHEET_COLUMNS = {'modules': ('id', 'name', 'total_hours'), 'entries': ('week', 'module_id', 'hours')}
+
+# Padded to the sheet's size so rows left over from a longer list are blanked in the same write
+def sheet_values(worksheet, worksheet_name, data):
+    cols = SHEET_COLUMNS[worksheet_name]
+    rows = [list(cols)] + [[r[c] for c in cols] for r in data]
+    return rows + [[""] * len(cols) for _ in range(worksheet.row_count - len(rows))]
+
+def full_sheet_range(worksheet_name, data):
+    worksheet = get_worksheet(worksheet_name)
+    if len(data) + 1 > worksheet.row_count:
+        worksheet.add_rows(len(data) + 1 - worksheet.row_count)
+    return {"range": f"'{worksheet_name}'!A1", "values": sheet_values(worksheet, worksheet_name, data)}
+
+# Revision cell, rewritten by every entries save; deltas are only sent while it holds our revision
+ENTRIES_REV_CELL = "D1"
+
+def entries_rev(): return get_worksheet("entries").acell(ENTRIES_REV_CELL).value or ''
+
+# Row i + 2 holds entries[i]
+def entry_row_ranges(entries, rows, sheet_len):
+    worksheet = get_worksheet("entries")
+    cols = SHEET_COLUMNS["entries"]
+    if len(entries) + 1 > worksheet.row_count:
+        worksheet.add_rows(len(entries) + 1 - worksheet.row_count)
+    ranges = [{"range": f"'entries'!A{i + 2}:C{i + 2}", "values": [[entries[i][c] for c in cols]]}
+              for i in sorted(rows) if i < len(entries)]
+    if sheet_len > len(entries):
+        ranges.append({"range": f"'entries'!A{len(entries) + 2}:C{sheet_len + 1}",
+                       "values": [[""] * len(cols) for _ in range(sheet_len - len(entries))]})
+    return ranges
+
+def write_sheet_ranges(label, build):
     try:
-        sheet_url = st.secrets["google_sheets"]["url"]
-        creds = get_google_credentials(["https://www.googleapis.com/auth/spreadsheets"])
-        gc = gspread.authorize(creds)
-        sheet = gc.open_by_url(sheet_url)
-        try:
-            worksheet = sheet.worksheet(worksheet_name)
-        except Exception:
-            worksheet = sheet.add_worksheet(title=worksheet_name, rows="1000", cols="10")
-        if not data:
-            worksheet.clear()
-            return
-        df = pd.DataFrame(data)
-        if worksheet_name == "modules":
-            df = df[['id', 'name', 'total_hours']]
-        elif worksheet_name == "entries":
-            df = df[['week', 'module_id', 'hours']]
-        worksheet.update([df.columns.tolist()] + df.values.tolist())
+        data = build()
+        if data:
+            get_spreadsheet().values_batch_update({"valueInputOption": "RAW", "data": data})
+        return True
     except Exception as e:
-        st.error(f"❌ Failed to save '{worksheet_name}': {e}")
+        st.error(f"❌ Failed to save {label}: {e}")
+        get_worksheet.clear()  # the handle may be stale; reopen on next use
+        return False
+    finally:
+        clear_sheet_caches()
 
 # ==============================
 # GOOGLE DRIVE: LOAD CALENDARS
 # ==============================
+# Naive datetimes are local wall time; dates pass through untouched
+def to_local_datetimes(values, tz):
+    out = list(values)
+    naive = [i for i, v in enumerate(values) if isinstance(v, datetime) and v.tzinfo is None]
+    aware = [i for i, v in enumerate(values) if isinstance(v, datetime) and v.tzinfo is not None]
+    if naive:
+        idx = pd.DatetimeIndex([values[i] for i in naive]).tz_localize(tz, nonexistent='shift_forward', ambiguous=True)
+        for i, ts in zip(naive, idx.to_pydatetime()): out[i] = ts
+    if aware:
+        idx = pd.to_datetime([values[i] for i in aware], utc=True).tz_convert(tz)
+        for i, ts in zip(aware, idx.to_pydatetime()): out[i] = ts
+    return out
+
+def iter_vevents(cal, source):
+    # VEVENTs are direct children of VCALENDAR
+    for comp in cal.subcomponents:
+        if comp.name == "VEVENT":
+            dtstart, dtend = comp.get('dtstart'), comp.get('dtend')
+            if dtstart and dtend:
+                yield source, dtstart.dt, dtend.dt, str(comp.get('summary', 'No Title'))
+
+def extract_events(cal, source):
+    events = pd.DataFrame.from_records(iter_vevents(cal, source), columns=['source', 'start', 'end', 'summary'])
+    events['is_allday'] = (~events['start'].map(lambda x: isinstance(x, datetime))).astype(bool)
+    # sort_key: 0 for all-day, 86400 + seconds since midnight for timed events
+    events['date'] = events['start'].map(lambda x: x.date() if isinstance(x, datetime) else x)
+    events['sort_key'] = events['start'].map(
+        lambda x: 86400 + x.hour * 3600 + x.minute * 60 + x.second if isinstance(x, datetime) else 0).astype('int64')
+    events['time_str'] = "🕗 All-day"
+    timed = ~events['is_allday']
+    if timed.any():
+        local_tz = get_local_timezone()
+        for col in ('start', 'end'):
+            values = to_local_datetimes(events.loc[timed, col].tolist(), local_tz)
+            events.loc[timed, f'{col}_local'] = pd.Series(values, index=events.index[timed], dtype=object)
+        ends = events.loc[timed, 'end_local']
+        start_s = pd.to_datetime(events.loc[timed, 'start_local'], utc=True).dt.tz_convert(local_tz).dt.strftime('%H:%M')
+        end_s = pd.to_datetime(ends.where(ends.map(lambda x: isinstance(x, datetime))), utc=True).dt.tz_convert(local_tz).dt.strftime('%H:%M')
+        events.loc[timed, 'time_str'] = "🕒 " + start_s + " - " + end_s.fillna('??:??')
+    return events
+
+# Download keyed on modifiedTime, parse on the bytes
+@st.cache_data(show_spinner=False, max_entries=100)
+def fetch_ics_bytes(file_id, modified_time):
+    return execute_drive(get_drive_service().files().get_media(fileId=file_id))
+
+@st.cache_data(show_spinner=False, max_entries=100)
+def parse_ics_events(content, source):
+    from icalendar import Calendar
+    return extract_events(Calendar.from_ical(content), source)
+
+def load_events(file_id, modified_time, source):
+    return parse_ics_events(fetch_ics_bytes(file_id, modified_time), source)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def list_calendar_files(folder_id):
+    service = get_drive_service()
+    query = f"'{folder_id}' in parents and name contains '.ics' and trashed = false"
+    files, page_token = [], None
+    while True:
+        results = execute_drive(service.files().list(q=query, fields="nextPageToken, files(id, name, modifiedTime)",
+                                                     pageSize=1000, pageToken=page_token))
+        files.extend(results.get("files", []))
+        page_token = results.get("nextPageToken")
+        if not page_token: break
+    return files
+
 def load_calendars_from_drive():
     try:
-        folder_id = st.secrets["google_drive"]["folder_id"]
-        creds = get_google_credentials(["https://www.googleapis.com/auth/drive.readonly"])
-        service = build("drive", "v3", credentials=creds)
+        files = list_calendar_files(st.secrets["google_drive"]["folder_id"])
         
-        query = f"'{folder_id}' in parents and name contains '.ics' and trashed = false"
-        results = service.files().list(q=query, fields="files(id, name)").execute()
-        files = results.get("files", [])
-        
-        calendars = {}
-        for file in files:
-            file_id = file["id"]
-            file_name = file["name"]
-            request = service.files().get_media(fileId=file_id)
-            content = request.execute().decode("utf-8")
-            cal = Calendar.from_ical(content)
-            source_name = file_name.replace(".ics", "")
-            calendars[source_name] = cal
-        return calendars
+        # Skip the per-file lookups when nothing changed
+        signature = tuple((f["id"], f["name"], f.get("modifiedTime")) for f in files)
+        if st.session_state.get('calendar_signature') != signature:
+            # Workers need the script context for st.cache_data; a failing file is skipped
+            def load(file):
+                source_name = file["name"].replace(".ics", "")
+                try:
+                    return source_name, load_events(file["id"], file.get("modifiedTime"), source_name)
+                except Exception as e:
+                    return source_name, e
+            with ThreadPoolExecutor(max_workers=max(1, min(8, len(files))), initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as ex:
+                results = list(ex.map(load, files))
+            calendars, loaded = {}, []
+            for sig, (name, df) in zip(signature, results):
+                if isinstance(df, Exception):
+                    st.warning(f"⚠️ Could not load calendar '{name}': {df}")
+                else:
+                    calendars[name] = df
+                    loaded.append(sig)
+            st.session_state.calendars = calendars
+            # Derived views key on the files actually loaded
+            st.session_state.events_key = tuple(loaded)
+            st.session_state.all_events = pd.concat(calendars.values(), ignore_index=True) if calendars else None
+            # Only a complete load is remembered, so failed files are retried
+            st.session_state.calendar_signature = signature if len(loaded) == len(results) else None
+        return st.session_state.calendars
     except Exception as e:
         st.error(f"❌ Failed to load calendars from Google Drive: {e}")
         return {}
@@ -96,140 +236,416 @@ def load_calendars_from_drive():
 # ==============================
 # DATA LOADING (TEXT IDs)
 # ==============================
+@st.cache_data(ttl=60, show_spinner=False)
 def load_modules():
-    records = load_sheet_data("modules")
-    modules = []
-    for r in records:
-        try:
-            mod_id = str(r['id']).strip()
-            if not mod_id: continue
-            modules.append({
-                'id': mod_id,
-                'name': str(r['name']).strip(),
-                'total_hours': float(r['total_hours'])
-            })
-        except Exception:
-            st.warning(f"⚠️ Skipping invalid module: {r}")
-            continue
-    return modules
-
+    raw = load_sheet_data("modules")
+    df = raw.reindex(columns=['id', 'name', 'total_hours'])
+    df['id'] = df['id'].fillna('').astype(str).str.strip()
+    df = df[df['id'] != '']
+    df['name'] = df['name'].fillna('').astype(str).str.strip()
+    df['total_hours'] = pd.to_numeric(df['total_hours'], errors='coerce').astype('float64')
+    invalid = df['total_hours'].isna()
+    for i in df.index[invalid]:
+        st.warning(f"⚠️ Skipping invalid module: {raw.loc[i].to_dict()}")
+    return df[~invalid].to_dict('records')
+
+ENTRY_DTYPES = {'week': 'int16', 'module_id': 'category', 'hours': 'float64'}
+
+# Also returns the sheet's revision if it mirrors the parsed rows, else None
+@st.cache_data(ttl=60, show_spinner=False)
 def load_entries():
-    records = load_sheet_data("entries")
-    entries = []
-    for r in records:
-        try:
-            if not r.get('week') or not r.get('module_id') or not r.get('hours'):
-                continue
-            entries.append({
-                'week': int(float(r['week'])),
-                'module_id': str(r['module_id']).strip(),
-                'hours': float(r['hours'])
-            })
-        except Exception:
-            st.warning(f"⚠️ Skipping invalid entry: {r}")
-            continue
-    return entries
-
-def save_modules(modules):
-    save_sheet_data("modules", modules)
-
-def save_entries(entries):
-    save_sheet_data("entries", entries)
+    raw = load_sheet_data("entries")
+    df = raw.reindex(columns=['week', 'module_id', 'hours'])
+    # Rows with any blank/zero field are skipped silently
+    df = df[~(df.isna() | df.eq('') | df.apply(pd.to_numeric, errors='coerce').eq(0)).any(axis=1)]
+    week = pd.to_numeric(df['week'], errors='coerce')
+    hours = pd.to_numeric(df['hours'], errors='coerce')
+    invalid = week.isna() | hours.isna()
+    for i in df.index[invalid]:
+        st.warning(f"⚠️ Skipping invalid entry: {raw.loc[i].to_dict()}")
+    entries = pd.DataFrame({
+        'week': week[~invalid].astype('int64'),
+        'module_id': df.loc[~invalid, 'module_id'].astype(str).str.strip(),
+        'hours': hours[~invalid]
+    }).astype(ENTRY_DTYPES).reset_index(drop=True)
+    header = (read_sheet_values("entries") or [[]])[0]
+    synced = len(entries) == len(raw) and tuple(header[:3]) == SHEET_COLUMNS['entries']
+    return entries, (header[3] if len(header) > 3 else '') if synced else None
+
+# None means the next save rewrites the entries sheet in full
+def reset_entry_delta(rev=None):
+    st.session_state.entry_delta = None if rev is None else {'rows': set(), 'sheet_len': len(st.session_state.entries), 'rev': rev}
+
+def touch_entry_row(i):
+    if st.session_state.get('entry_delta') is not None:
+        st.session_state.entry_delta['rows'].add(i)
+
+# Mutations only mark a sheet dirty; flush_state writes it
+def mark_dirty(name):
+    st.session_state.dirty[name] = True
+    st.session_state.module_stats = st.session_state.report_data = None
+    if name == 'modules':
+        st.session_state.module_index = None
+    else:
+        st.session_state.entries_df = None
+        st.session_state.week_totals = None
+
+# One values.batchUpdate per flush; a failed write keeps the dirty flags
+def flush_state():
+    dirty, delta = st.session_state.dirty, st.session_state.get('entry_delta')
+    # Never overwrite the sheets from a session that failed to load them
+    if st.session_state.get('load_failed') or not (dirty['modules'] or dirty['entries']):
+        return
+    written = {'rev': delta and delta['rev']}
+    def build():
+        data = []
+        if dirty['modules']:
+            data.append(full_sheet_range("modules", st.session_state.modules))
+        entries = st.session_state.entries
+        # e.g. deleting a module with no entries
+        unchanged = delta is not None and not delta['rows'] and delta['sheet_len'] == len(entries)
+        if dirty['entries'] and not unchanged:
+            if delta is not None and entries_rev() == delta['rev']:
+                data += entry_row_ranges(entries, delta['rows'], delta['sheet_len'])
+            else:
+                data.append(full_sheet_range("entries", entries))
+            written['rev'] = uuid.uuid4().hex
+            data.append({"range": f"'entries'!{ENTRIES_REV_CELL}", "values": [[written['rev']]]})
+        return data
+    label = "modules and entries" if dirty['modules'] and dirty['entries'] else f"'{'modules' if dirty['modules'] else 'entries'}'"
+    saved = write_sheet_ranges(label, build)
+    if dirty['entries']:
+        reset_entry_delta(written['rev'] if saved else None)
+    if saved:
+        dirty['modules'] = dirty['entries'] = False
 
 # ==============================
 # HELPER FUNCTIONS
 # ==============================
+# Table order is the priority (e.g. 'apple-gmail' is gmail)
+SOURCE_COLORS = {'gmail': '#EA4335', 'samsung': '#1428A0', 'outlook': '#0078D4', 'apple': '#555555'}
+SOURCE_ICONS = {'gmail': '📧', 'google': '📧', 'samsung': '📱', 'outlook': '📨', 'apple': '🍎', 'icloud': '🍎'}
+SOURCE_COLOR_RE = re.compile('|'.join(map(re.escape, SOURCE_COLORS)))
+SOURCE_ICON_RE = re.compile('|'.join(map(re.escape, SOURCE_ICONS)))
+
+def match_source(pattern, table, source):
+    hits = pattern.findall(source.lower())
+    return table[min(hits, key=list(table).index)] if hits else None
+
+@lru_cache(maxsize=None)
 def get_source_color(source):
-    color_map = {'gmail': '#EA4335', 'samsung': '#1428A0', 'outlook': '#0078D4', 'apple': '#555555'}
-    source_lower = source.lower()
-    for key, color in color_map.items():
-        if key in source_lower:
-            return color
-    import hashlib
-    return f"#{hashlib.md5(source.encode()).hexdigest()[:6]}"
+    return match_source(SOURCE_COLOR_RE, SOURCE_COLORS, source) or f"#{zlib.crc32(source.encode()) & 0xFFFFFF:06x}"
 
+@lru_cache(maxsize=None)
 def get_source_icon(source):
-    s = source.lower()
-    return '📧' if 'gmail' in s or 'google' in s else '📱' if 'samsung' in s else '📨' if 'outlook' in s else '🍎' if 'apple' in s or 'icloud' in s else '📅'
+    return match_source(SOURCE_ICON_RE, SOURCE_ICONS, source) or '📅'
+
+# tzlocal gives a DST-aware zone
+@st.cache_resource
+def get_local_timezone():
+    from tzlocal import get_localzone
+    return get_localzone()
 
+@lru_cache(maxsize=256)
 def get_week_monday(d): return d - timedelta(days=d.weekday())
-def get_week_number(): return datetime.now().isocalendar()[1]
-def get_week_dates(year, week): 
+
+@lru_cache(maxsize=256)
+def get_week_number(d): return d.isocalendar()[1]
+
+@lru_cache(maxsize=256)
+def get_week_dates(year, week):
     jan1 = datetime(year, 1, 1)
-    return (jan1 + timedelta(days=(week - 1) * 7 - jan1.weekday()), 
-            jan1 + timedelta(days=(week - 1) * 7 - jan1.weekday() + 6))
+    monday = jan1 - timedelta(days=jan1.weekday()) + timedelta(weeks=week - 1)
+    return monday, monday + timedelta(days=6)
+
+def rebuild_entry_index():
+    index = {}
+    for i, e in enumerate(st.session_state.entries):
+        index.setdefault((e['week'], e['module_id']), i)
+    st.session_state.entry_index = index
+
+# module id -> positions (ids aren't enforced unique)
+def get_module_index():
+    if st.session_state.get('module_index') is None:
+        index = {}
+        for i, m in enumerate(st.session_state.modules):
+            index.setdefault(m['id'], []).append(i)
+        st.session_state.module_index = index
+    return st.session_state.module_index
+
+def get_entries_df():
+    if st.session_state.get('entries_df') is None:
+        st.session_state.entries_df = pd.DataFrame(st.session_state.entries, columns=list(ENTRY_DTYPES)).astype(ENTRY_DTYPES)
+    return st.session_state.entries_df
 
 def calculate_module_stats():
-    return [{**m, 'claimed': sum(e['hours'] for e in st.session_state.entries if e['module_id'] == m['id']),
-             'remaining': m['total_hours'] - sum(e['hours'] for e in st.session_state.entries if e['module_id'] == m['id'])}
-            for m in st.session_state.modules]
-
-def calculate_week_total(w): return sum(e['hours'] for e in st.session_state.entries if e['week'] == w)
-def get_entry_hours(w, mid): return next((e['hours'] for e in st.session_state.entries if e['week'] == w and e['module_id'] == mid), 0.0)
-def get_module_name(mid): return next((m['name'] for m in st.session_state.modules if m['id'] == mid), "Unknown")
+    if st.session_state.get('module_stats') is None:
+        if not st.session_state.modules:
+            return []
+        claimed = get_entries_df().groupby('module_id', observed=True)['hours'].sum()
+        stats = pd.DataFrame(st.session_state.modules)
+        stats['claimed'] = stats['id'].map(claimed).astype('float64').fillna(0.0)
+        stats['remaining'] = stats['total_hours'] - stats['claimed']
+        st.session_state.module_stats = stats.to_dict('records')
+    return st.session_state.module_stats
+
+def get_week_totals():
+    if st.session_state.get('week_totals') is None:
+        st.session_state.week_totals = get_entries_df().groupby('week')['hours'].sum().to_dict()
+    return st.session_state.week_totals
+
+def calculate_week_total(w): return get_week_totals().get(w, 0.0)
+def get_entry_hours(w, mid):
+    idx = st.session_state.entry_index.get((w, mid))
+    return st.session_state.entries[idx]['hours'] if idx is not None else 0.0
 
 def add_module(code, name, hours):
     st.session_state.modules.append({'id': code, 'name': name, 'total_hours': hours})
-    save_modules(st.session_state.modules)
+    mark_dirty('modules')
 
 def delete_module(mid):
     st.session_state.modules = [m for m in st.session_state.modules if m['id'] != mid]
-    st.session_state.entries = [e for e in st.session_state.entries if e['module_id'] != mid]
-    save_modules(st.session_state.modules); save_entries(st.session_state.entries)
-
-def update_module(mid, name, hours):
-    for m in st.session_state.modules:
-        if m['id'] == mid:
-            m.update({'name': name, 'total_hours': hours})
-    save_modules(st.session_state.modules)
-
-def add_or_update_entry(week, mid, hours):
-    for e in st.session_state.entries:
-        if e['week'] == week and e['module_id'] == mid:
-            if hours == 0:
-                st.session_state.entries.remove(e)
-            else:
-                e['hours'] = hours
-            save_entries(st.session_state.entries)
-            return
+    for week in [e['week'] for e in st.session_state.entries if e['module_id'] == mid]:
+        set_entry_hours(week, mid, 0)
+    if any(e['module_id'] == mid for e in st.session_state.entries):
+        # duplicate (week, module) rows the index doesn't track
+        st.session_state.entries = [e for e in st.session_state.entries if e['module_id'] != mid]
+        rebuild_entry_index()
+        reset_entry_delta(None)
+    mark_dirty('modules'); mark_dirty('entries')
+
+def update_module(mid, code, name, hours):
+    for i in get_module_index().get(mid, []):
+        st.session_state.modules[i].update({'id': code, 'name': name, 'total_hours': hours})
+    mark_dirty('modules')
+
+# Returns True if entries changed
+def set_entry_hours(week, mid, hours):
+    entries, index = st.session_state.entries, st.session_state.entry_index
+    idx = index.pop((week, mid), None) if hours == 0 else index.get((week, mid))
+    if idx is not None:
+        if hours == 0:
+            # swap-with-last removal
+            last = entries.pop()
+            if idx < len(entries):
+                entries[idx] = last
+                touch_entry_row(idx)
+                last_key = (last['week'], last['module_id'])
+                if index.get(last_key) == len(entries):
+                    index[last_key] = idx
+            return True
+        if entries[idx]['hours'] != hours:
+            entries[idx]['hours'] = hours
+            touch_entry_row(idx)
+            return True
+        return False
     if hours > 0:
-        st.session_state.entries.append({'week': week, 'module_id': mid, 'hours': hours})
-        save_entries(st.session_state.entries)
-
-def create_detailed_report_df():
-    data = []
-    for e in st.session_state.entries:
-        year = datetime.now().year
-        monday, _ = get_week_dates(year, e['week'])
-        data.append({
-            'Week': e['week'],
-            'Week Start': monday.strftime('%Y-%m-%d'),
-            'Week End': (monday + timedelta(days=6)).strftime('%Y-%m-%d'),
-            'Module': get_module_name(e['module_id']),
-            'Hours': e['hours']
-        })
-    return pd.DataFrame(data)
+        entries.append({'week': week, 'module_id': mid, 'hours': hours})
+        index[(week, mid)] = len(entries) - 1
+        touch_entry_row(len(entries) - 1)
+        return True
+    return False
+
+def bulk_update_entries(week, hours_by_module):
+    changed = [set_entry_hours(week, mid, hours) for mid, hours in hours_by_module.items()]
+    if any(changed):
+        mark_dirty('entries')
+
+# Frozen snapshots for the report builders; the session lists stay dicts
+Entry = namedtuple('Entry', 'week module_id hours')
+Module = namedtuple('Module', 'id name')
+def entries_key(): return tuple(Entry(e['week'], e['module_id'], e['hours']) for e in st.session_state.entries)
+def modules_key(): return tuple(Module(m['id'], m['name']) for m in st.session_state.modules)
+
+# Report caches key on a digest of the snapshots, which ride along unhashed
+def report_data():
+    if st.session_state.get('report_data') is None:
+        entries, modules = entries_key(), modules_key()
+        version = hashlib.blake2b(repr((entries, modules)).encode(), digest_size=16).hexdigest()
+        st.session_state.report_data = (version, entries, modules)
+    return st.session_state.report_data
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def create_detailed_report_df(version, _entries, _modules, year):
+    df = pd.DataFrame.from_records(_entries, columns=Entry._fields)
+    names = dict(reversed(_modules))  # first match wins for duplicate ids
+    # Dates formatted once per distinct week
+    jan1 = pd.Timestamp(year, 1, 1)
+    base = jan1 - pd.Timedelta(days=jan1.weekday())
+    weeks = pd.Index(df['week'].unique())
+    monday = base + pd.to_timedelta((weeks - 1) * 7, unit='D')
+    starts = dict(zip(weeks, monday.strftime('%Y-%m-%d')))
+    ends = dict(zip(weeks, (monday + pd.Timedelta(days=6)).strftime('%Y-%m-%d')))
+    return pd.DataFrame({
+        'Week': df['week'].astype('int32'),
+        'Week Start': df['week'].map(starts),
+        'Week End': df['week'].map(ends),
+        'Module': df['module_id'].map(names).fillna("Unknown").astype('category'),
+        'Hours': df['hours']
+    })
+
+def filter_weeks(df, start, end): return df[(df['Week'] >= start) & (df['Week'] <= end)]
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def report_range(version, _entries, _modules, year, start, end):
+    return filter_weeks(create_detailed_report_df(version, _entries, _modules, year), start, end)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def report_table(version, _entries, _modules, year, start, end):
+    return report_range(version, _entries, _modules, year, start, end).sort_values(['Week', 'Module'])
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def report_summary(version, _entries, _modules, year):
+    df = create_detailed_report_df(version, _entries, _modules, year)
+    weekly = df.groupby('Week')['Hours'].sum()
+    # categories are exactly the distinct names
+    return {'total': df['Hours'].sum(), 'weeks': len(weekly), 'modules': df['Module'].cat.categories.size,
+            'avg_weekly': weekly.mean(), 'weekly': weekly}
+
+REPORT_TOTAL = '(Total)'
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def report_aggregates(version, _entries, _modules, year, start, end):
+    fdf = report_range(version, _entries, _modules, year, start, end)
+    if fdf.empty:
+        return pd.DataFrame(columns=['Week', 'Hours']), pd.DataFrame(columns=['Module', 'Hours'])
+    pivot = fdf.pivot_table(values='Hours', index='Week', columns='Module', aggfunc='sum', fill_value=0,
+                            margins=True, margins_name=REPORT_TOTAL, observed=True)
+    weekly = pivot[REPORT_TOTAL].drop(REPORT_TOTAL).rename('Hours')
+    weekly.index = weekly.index.astype(int)
+    by_module = pivot.loc[REPORT_TOTAL].drop(REPORT_TOTAL).rename('Hours').rename_axis('Module')
+    return weekly.reset_index(), by_module.reset_index()
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def weekly_hours_fig(version, _entries, _modules, year, start, end):
+    import plotly.graph_objects as go
+    wd = report_aggregates(version, _entries, _modules, year, start, end)[0]
+    fig = go.Figure(go.Bar(x=wd['Week'], y=wd['Hours'], marker_color=np.where(wd['Hours'].to_numpy() > 37.5, 'red', 'green'), text=wd['Hours'].round(1)))
+    fig.add_hline(y=37.5, line_dash="dash", line_color="red")
+    return fig
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def module_hours_fig(version, _entries, _modules, year, start, end):
+    import plotly.express as px
+    return px.pie(report_aggregates(version, _entries, _modules, year, start, end)[1], values='Hours', names='Module')
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def module_progress_fig(progress):
+    import plotly.graph_objects as go
+    ids, claimed, remaining = zip(*progress)
+    fig = go.Figure()
+    fig.add_bar(x=ids, y=claimed, name='Claimed')
+    fig.add_bar(x=ids, y=remaining, name='Remaining')
+    fig.update_layout(barmode='stack', height=400)
+    return fig
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def weekly_module_fig(version, _entries, _modules, year, start, end):
+    import plotly.express as px
+    return px.bar(report_range(version, _entries, _modules, year, start, end), x='Week', y='Hours', color='Module', barmode='stack', height=400)
 
 def to_excel(df):
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    ws.append(df.columns.tolist())
+    for row in df.itertuples(index=False):
+        ws.append(row)
     output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as w: df.to_excel(w, index=False)
+    wb.save(output)
     return output.getvalue()
 
+# ==============================
+# CALENDAR WEEK VIEW
+# ==============================
+# _events is not hashed; the Drive signature identifies it
+@st.cache_data(show_spinner=False, max_entries=16)
+def group_events_by_day(signature, _events):
+    evdf = _events.copy()
+    sources = evdf['source'].unique()
+    evdf['color'] = evdf['source'].map({s: get_source_color(s) for s in sources})
+    evdf['icon'] = evdf['source'].map({s: get_source_icon(s) for s in sources})
+    c, summary = evdf['color'], evdf['summary'].astype(str)
+    evdf['html'] = ("<div style='background-color:" + c + "22;padding:10px;border-left:4px solid " + c
+                    + ";border-radius:4px;margin-bottom:8px;'><strong style='color:" + c + "'>" + evdf['icon'] + " "
+                    + evdf['source'] + "</strong> | " + evdf['time_str'] + "<br><span>" + summary + "</span></div>")
+    # groupby keeps row order within each day
+    evdf = evdf.sort_values('sort_key', kind='stable')
+    return dict(tuple(evdf.groupby('date', sort=False)))
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def calendar_legend_html(signature, _events):
+    sources = sorted(_events['source'].unique())
+    legend = "".join(f"<div><span style='color:{get_source_color(s)}'>●</span> {get_source_icon(s)} <strong>{s}</strong></div>" for s in sources)
+    return f"<div style='display:grid;grid-template-columns:repeat({min(len(sources), 4)},1fr);gap:4px 16px;'>{legend}</div>"
+
+# A fragment: week navigation reruns only this view
+@st.fragment
+def calendar_week_view(legend_html, events_by_day):
+    # Navigation
+    col1, col2, col3, col4 = st.columns([1, 2, 1, 1])
+    with col1: 
+        if st.button("◀ Previous Week"): 
+            st.session_state.calendar_week_start -= timedelta(days=7); st.rerun(scope="fragment")
+    with col2:
+        end = st.session_state.calendar_week_start + timedelta(days=6)
+        st.markdown(f"### {st.session_state.calendar_week_start.strftime('%B %d')} – {end.strftime('%B %d, %Y')}")
+    with col3: 
+        if st.button("Next Week ▶"): 
+            st.session_state.calendar_week_start += timedelta(days=7); st.rerun(scope="fragment")
+    with col4: 
+        if st.button("Today"): 
+            st.session_state.calendar_week_start = get_week_monday(datetime.today().date()); st.rerun(scope="fragment")
+    
+    # Legend
+    st.markdown("---")
+    st.markdown(legend_html, unsafe_allow_html=True)
+    
+    # Weekly view
+    st.markdown("---")
+    current = st.session_state.calendar_week_start
+    for i in range(7):
+        day_df = events_by_day.get(current)
+        with st.expander(f"{'🌅' if i>=5 else '📅'} {current.strftime('%A, %B %d')}", expanded=i<2):
+            if day_df is None:
+                st.info("No events")
+            else:
+                st.markdown("".join(day_df['html']), unsafe_allow_html=True)
+        current += timedelta(days=1)
+
 # ==============================
 # SESSION STATE INIT
 # ==============================
+# Clock read once per rerun
+NOW = datetime.now()
+TODAY, YEAR = NOW.date(), NOW.year
+
 if 'modules' not in st.session_state:
-    st.session_state.modules = load_modules()
-    st.session_state.entries = load_entries()
+    try:
+        modules = load_modules()
+        entries_df, rev = load_entries()
+    except Exception as e:
+        st.warning(f"⚠️ Could not load data from Google Sheets: {e}")
+        modules, entries_df, rev = [], pd.DataFrame(columns=list(ENTRY_DTYPES)).astype(ENTRY_DTYPES), None
+        st.session_state.load_failed = True
+    st.session_state.modules, st.session_state.entries_df = modules, entries_df
+    st.session_state.entries = entries_df.to_dict('records')
+    reset_entry_delta(rev)
+
+if 'dirty' not in st.session_state:
+    st.session_state.dirty = {'modules': False, 'entries': False}
+
+if 'entry_index' not in st.session_state:
+    rebuild_entry_index()
 
 if 'page' not in st.session_state:
     st.session_state.page = 'modules'
 
 if 'calendar_week_start' not in st.session_state:
-    st.session_state.calendar_week_start = get_week_monday(datetime.today().date())
+    st.session_state.calendar_week_start = get_week_monday(TODAY)
 
 if 'selected_week' not in st.session_state:
-    st.session_state.selected_week = get_week_number()
+    st.session_state.selected_week = get_week_number(TODAY)
 
 # ==============================
 # NAVIGATION
@@ -238,7 +654,13 @@ st.sidebar.title("Navigation")
 page = st.sidebar.radio("Go to:", ["📚 Modules", "⏰ Claim Hours", "📊 Reports", "📅 Calendar Viewer"])
 st.session_state.page = {'📚 Modules': 'modules', '⏰ Claim Hours': 'claim', '📊 Reports': 'reports', '📅 Calendar Viewer': 'calendar'}[page]
 
-if st.session_state.page in ['modules', 'claim', 'reports']:
+if st.session_state.get('load_failed'):
+    st.sidebar.error("❌ Google Sheets data could not be loaded, so changes won't be saved. Reload the page to retry.")
+elif st.session_state.dirty['modules'] or st.session_state.dirty['entries']:
+    st.sidebar.warning("⚠️ Unsaved changes")
+    if st.sidebar.button("💾 Save Changes", width='stretch'):
+        flush_state(); st.rerun()
+elif st.session_state.page in ['modules', 'claim', 'reports']:
     st.info("✅ Data saved securely in Google Sheets")
 
 # ==============================
@@ -257,7 +679,7 @@ if st.session_state.page == 'modules':
             if code and name and hours > 0:
                 add_module(code, name, hours)
                 st.success(f"✅ Added: {code} - {name}")
-                st.rerun()
+                flush_state(); st.rerun()
     
     st.markdown("---")
     if not st.session_state.modules:
@@ -273,20 +695,17 @@ if st.session_state.page == 'modules':
                     st.caption(f"Claimed: {m['claimed']:.1f}h | Remaining: {m['remaining']:.1f}h")
                 with col3:
                     if st.button("✏️", key=f"edit_{m['id']}"): st.session_state[f'editing_{m["id"]}'] = True
-                    if st.button("🗑️", key=f"del_{m['id']}"): delete_module(m['id']); st.rerun()
+                    if st.button("🗑️", key=f"del_{m['id']}"): delete_module(m['id']); flush_state(); st.rerun()
                 
                 if st.session_state.get(f'editing_{m["id"]}', False):
                     with st.form(f'form_{m["id"]}'):
                         e_code = st.text_input("Code", m['id'])
                         e_name = st.text_input("Name", m['name'])
-                        e_hours = st.number_input("Hours", float(m['total_hours']), min_value=0.0, step=0.5)
+                        e_hours = st.number_input("Hours", value=float(m['total_hours']), min_value=0.0, step=0.5)
                         if st.form_submit_button("💾 Save", type="primary"):
-                            for mod in st.session_state.modules:
-                                if mod['id'] == m['id']:
-                                    mod.update({'id': e_code, 'name': e_name, 'total_hours': e_hours})
-                            save_modules(st.session_state.modules)
+                            update_module(m['id'], e_code, e_name, e_hours)
                             st.session_state[f'editing_{m["id"]}'] = False
-                            st.rerun()
+                            flush_state(); st.rerun()
                         if st.form_submit_button("❌ Cancel"):
                             st.session_state[f'editing_{m["id"]}'] = False
                             st.rerun()
@@ -301,16 +720,16 @@ elif st.session_state.page == 'claim':
     col1, col2 = st.columns([3, 1])
     with col1:
         # Default to today
-        default_date = datetime.today().date()
+        default_date = TODAY
         selected_date = st.date_input(
             "Choose a date to log hours for",
             value=default_date,
-            max_value=datetime.today().date(),  # Prevent future dates
+            max_value=TODAY,  # Prevent future dates
             label_visibility="collapsed"
         )
     with col2:
         if st.button("📆 Today", use_container_width=True):
-            st.session_state.claim_date = datetime.today().date()
+            st.session_state.claim_date = TODAY
             st.rerun()
     
     # Auto-calculate week from selected date
@@ -334,37 +753,35 @@ elif st.session_state.page == 'claim':
     if not st.session_state.modules:
         st.warning("Add modules first.")
     else:
-        for m in calculate_module_stats():
-            with st.container():
-                col1, col2 = st.columns([3, 1])
-                with col1:
-                    st.markdown(f"**{m['id']} - {m['name']}**")
-                    st.caption(f"Remaining: {m['remaining']:.1f}h of {m['total_hours']}h")
-                with col2:
-                    saved = get_entry_hours(selected_week, m['id'])
-                    key = f"input_{m['id']}"
-                    if key not in st.session_state:
-                        st.session_state[key] = float(saved)
-                    temp = st.number_input(
-                        "Hours",
-                        min_value=0.0,
-                        max_value=200.0,
-                        value=st.session_state[key],
-                        step=0.5,
-                        key=f"ni_{m['id']}",
-                        label_visibility="collapsed"
-                    )
-                    st.session_state[key] = temp
-                    b1, b2 = st.columns(2)
-                    with b1:
-                        if st.button("✅ Claim", key=f"claim_{m['id']}", use_container_width=True):
-                            add_or_update_entry(selected_week, m['id'], temp)
-                            st.rerun()
-                    with b2:
-                        if st.button("🔄 Reset", key=f"reset_{m['id']}", use_container_width=True):
-                            st.session_state[key] = float(saved)
-                            st.rerun()
-                st.markdown("---")
+        # A submit writes only the rows whose hours changed
+        stats = calculate_module_stats()
+        editor_df = pd.DataFrame({
+            'Module': [f"{m['id']} - {m['name']}" for m in stats],
+            'Hours': [float(get_entry_hours(selected_week, m['id'])) for m in stats],
+            'Remaining': [f"{m['remaining']:.1f}h of {m['total_hours']}h" for m in stats],
+        }, index=pd.Index([m['id'] for m in stats], name='id'))
+        editor_key = f"hours_editor_{selected_week}"
+        with st.form('week_form'):
+            edited = st.data_editor(
+                editor_df,
+                key=editor_key,
+                hide_index=True,
+                width='stretch',
+                disabled=['Module', 'Remaining'],
+                column_config={'Hours': st.column_config.NumberColumn("Hours", min_value=0.0, max_value=200.0, step=0.5, required=True)}
+            )
+            b1, b2 = st.columns(2)
+            with b1: save_week = st.form_submit_button("✅ Save week", type="primary", width='stretch')
+            with b2: reset_week = st.form_submit_button("🔄 Reset", width='stretch')
+        if save_week:
+            changed = edited['Hours'].ne(editor_df['Hours'])
+            if changed.any():
+                bulk_update_entries(selected_week, edited.loc[changed, 'Hours'].astype(float).to_dict())
+            st.session_state.pop(editor_key, None)
+            flush_state(); st.rerun()
+        if reset_week:
+            st.session_state.pop(editor_key, None)
+            st.rerun()
         if over:
             st.warning("⚠️ Remember: You cannot claim more than 37.5 hours per week!")
 
@@ -373,135 +790,72 @@ elif st.session_state.page == 'reports':
     if not st.session_state.entries:
         st.warning("No data yet.")
     else:
-        df = create_detailed_report_df()
+        (version, ekey, mkey), year = report_data(), YEAR
+        summary = report_summary(version, ekey, mkey, year)
         st.markdown("---")
         c1, c2, c3, c4 = st.columns(4)
-        with c1: st.metric("Total Hours", f"{df['Hours'].sum():.1f}")
-        with c2: st.metric("Weeks", df['Week'].nunique())
-        with c3: st.metric("Modules", df['Module'].nunique())
-        with c4: st.metric("Avg Weekly", f"{df.groupby('Week')['Hours'].sum().mean():.1f}")
+        with c1: st.metric("Total Hours", f"{summary['total']:.1f}")
+        with c2: st.metric("Weeks", summary['weeks'])
+        with c3: st.metric("Modules", summary['modules'])
+        with c4: st.metric("Avg Weekly", f"{summary['avg_weekly']:.1f}")
         
         st.markdown("---")
-        weeks = sorted(df['Week'].unique())
+        weeks = summary['weekly'].index.tolist()
         c1, c2 = st.columns(2)
         start = c1.selectbox("From Week", weeks, 0)
         end = c2.selectbox("To Week", weeks, len(weeks)-1)
-        fdf = df[(df['Week'] >= start) & (df['Week'] <= end)]
+        fdf = report_range(version, ekey, mkey, year, start, end)
         
         st.markdown("---")
         t1, t2, t3, t4 = st.tabs(["📊 Weekly", "🎯 By Module", "📉 Progress", "📅 Weekly x Module"])
         with t1:
-            wd = fdf.groupby('Week')['Hours'].sum().reset_index()
-            fig = go.Figure(go.Bar(x=wd['Week'], y=wd['Hours'], marker_color=['red' if h>37.5 else 'green' for h in wd['Hours']], text=wd['Hours'].round(1)))
-            fig.add_hline(y=37.5, line_dash="dash", line_color="red")
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(weekly_hours_fig(version, ekey, mkey, year, start, end), use_container_width=True)
         with t2:
-            md = fdf.groupby('Module')['Hours'].sum().reset_index()
-            st.plotly_chart(px.pie(md, values='Hours', names='Module'), use_container_width=True)
+            st.plotly_chart(module_hours_fig(version, ekey, mkey, year, start, end), use_container_width=True)
         with t3:
             stats = calculate_module_stats()
             if stats:
-                dfp = pd.DataFrame(stats)
-                fig = go.Figure()
-                fig.add_bar(x=dfp['id'], y=dfp['claimed'], name='Claimed')
-                fig.add_bar(x=dfp['id'], y=dfp['remaining'], name='Remaining')
-                fig.update_layout(barmode='stack', height=400)
-                st.plotly_chart(fig, use_container_width=True)
+                progress = tuple((m['id'], m['claimed'], m['remaining']) for m in stats)
+                st.plotly_chart(module_progress_fig(progress), use_container_width=True)
         with t4:
             if not fdf.empty:
-                pivot = fdf.pivot_table(values='Hours', index='Week', columns='Module', fill_value=0)
-                fig = go.Figure()
-                for col in pivot.columns:
-                    fig.add_bar(x=pivot.index, y=pivot[col], name=col)
-                fig.update_layout(barmode='stack', height=400)
-                st.plotly_chart(fig, use_container_width=True)
+                st.plotly_chart(weekly_module_fig(version, ekey, mkey, year, start, end), use_container_width=True)
         
         st.markdown("---")
         c1, c2 = st.columns(2)
-        with c1: st.download_button("📄 CSV", fdf.to_csv(index=False), f"report_{start}-{end}.csv", use_container_width=True)
-        with c2: st.download_button("📊 Excel", to_excel(fdf), f"report_{start}-{end}.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", use_container_width=True)
-        st.dataframe(fdf.sort_values(['Week', 'Module']), use_container_width=True, hide_index=True)
+        with c1: st.download_button("📄 CSV", partial(fdf.to_csv, index=False), f"report_{start}-{end}.csv", mime="text/csv", use_container_width=True)
+        with c2: st.download_button("📊 Excel", partial(to_excel, fdf), f"report_{start}-{end}.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", use_container_width=True)
+        st.dataframe(report_table(version, ekey, mkey, year, start, end), use_container_width=True, hide_index=True)
 
 else:
     # CALENDAR VIEWER — FROM GOOGLE DRIVE
-    st.session_state.calendar_week_start = get_week_monday(datetime.today().date())
+    st.session_state.calendar_week_start = get_week_monday(TODAY)
     st.title("📅 Calendar Viewer")
     calendars = load_calendars_from_drive()
     if not calendars:
         st.stop()
     
-    all_events = []
-    for src, cal in calendars.items():
-        for comp in cal.walk():
-            if comp.name == "VEVENT":
-                dtstart, dtend = comp.get('dtstart'), comp.get('dtend')
-                if not dtstart or not dtend: continue
-                all_events.append({
-                    'start': dtstart.dt,
-                    'end': dtend.dt,
-                    'summary': str(comp.get('summary', 'No Title')),
-                    'is_allday': not isinstance(dtstart.dt, datetime),
-                    'source': src
-                })
+    all_events = st.session_state.all_events
     
-    if not all_events:
+    if all_events.empty:
         st.warning("📭 No events found.")
         st.stop()
     
-    # Navigation
-    col1, col2, col3, col4 = st.columns([1, 2, 1, 1])
-    with col1: 
-        if st.button("◀ Previous Week"): 
-            st.session_state.calendar_week_start -= timedelta(days=7); st.rerun()
-    with col2:
-        end = st.session_state.calendar_week_start + timedelta(days=6)
-        st.markdown(f"### {st.session_state.calendar_week_start.strftime('%B %d')} – {end.strftime('%B %d, %Y')}")
-    with col3: 
-        if st.button("Next Week ▶"): 
-            st.session_state.calendar_week_start += timedelta(days=7); st.rerun()
-    with col4: 
-        if st.button("Today"): 
-            st.session_state.calendar_week_start = get_week_monday(datetime.today().date()); st.rerun()
-    
-    # Legend
-    sources = sorted(set(e['source'] for e in all_events))
-    st.markdown("---")
-    cols = st.columns(min(len(sources), 4))
-    for i, s in enumerate(sources):
-        with cols[i % 4]:
-            st.markdown(f"<span style='color:{get_source_color(s)}'>●</span> {get_source_icon(s)} **{s}**", unsafe_allow_html=True)
-    
-    # Weekly view
-    st.markdown("---")
-    current = st.session_state.calendar_week_start
-    local_tz = datetime.now().astimezone().tzinfo
-    for i in range(7):
-        target = current
-        day_events = [e for e in all_events if (e['start'].date() if isinstance(e['start'], datetime) else e['start']) == target]
-        day_events.sort(key=lambda x: (not x['is_allday'], x['start'].time() if isinstance(x['start'], datetime) else datetime.min.time()))
-        with st.expander(f"{'🌅' if i>=5 else '📅'} {current.strftime('%A, %B %d')}", expanded=i<2):
-            if not day_events:
-                st.info("No events")
-            else:
-                for e in day_events:
-                    color = get_source_color(e['source'])
-                    icon = get_source_icon(e['source'])
-                    if e['is_allday']:
-                        time_str = "🕗 All-day"
-                    else:
-                        start = e['start'].replace(tzinfo=local_tz) if e['start'].tzinfo is None else e['start'].astimezone(local_tz)
-                        end = e['end'].replace(tzinfo=local_tz) if isinstance(e['end'], datetime) and e['end'].tzinfo is None else (e['end'].astimezone(local_tz) if isinstance(e['end'], datetime) else e['end'])
-                        time_str = f"🕒 {start.strftime('%H:%M')} - {end.strftime('%H:%M') if isinstance(end, datetime) else '??:??'}"
-                    st.markdown(f"<div style='background-color:{color}22;padding:10px;border-left:4px solid {color};border-radius:4px;margin-bottom:8px;'><strong style='color:{color}'>{icon} {e['source']}</strong> | {time_str}<br><span>{e['summary']}</span></div>", unsafe_allow_html=True)
-        current += timedelta(days=1)
+    signature = st.session_state.events_key
+    calendar_week_view(calendar_legend_html(signature, all_events), group_events_by_day(signature, all_events))
     
     # Stats
     st.markdown("---")
     c1, c2, c3 = st.columns(3)
     with c1: st.metric("Events", len(all_events))
     with c2: st.metric("Calendars", len(calendars))
-    with c3: st.metric("All-day", sum(1 for e in all_events if e['is_allday']))
+    with c3: st.metric("All-day", int(all_events['is_allday'].sum()))
     
     if st.button("🔄 Reload Calendars"):
-        st.cache_data.clear()
-        st.rerun()
\ No newline at end of file
+        # Downloads/parses are keyed on modifiedTime; only the listing is refreshed
+        list_calendar_files.clear()
+        st.session_state.pop('calendar_signature', None)
+        st.rerun()
+
+# Safety net for mutations not followed by an explicit flush
+flush_state()